@@ -0,0 +1,114 @@
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+
+# Бенчмарк памяти сервера на простаивающих соединениях.
+# Сервер запускается в отдельном процессе, клиенты подключаются, проходят
+# ввод имени и остаются в комнате main без активности. На контрольных точках
+# снимается RSS процесса сервера и считается прирост на одно соединение.
+
+BENCH_HOST = '127.0.0.1'
+BENCH_PORT = 8899
+CONNECT_BATCH = 500
+# Один адрес источника дает около 28 тыс. эфемерных портов, поэтому клиенты
+# распределяются по нескольким адресам 127.0.0.x
+CLIENTS_PER_SOURCE_ADDR = 20000
+
+def raise_nofile_limit():
+    """Увеличение лимита открытых файловых дескрипторов до жесткого."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+def read_rss_kib(pid):
+    """Чтение RSS процесса в КиБ из /proc."""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    raise RuntimeError("VmRSS не найден")
+
+async def drain_gui_queues(server):
+    """Очистка очередей GUI вместо окна сервера."""
+    while True:
+        for q in (server.log_queue, server.client_list_queue, server.room_list_queue):
+            while not q.empty():
+                q.get_nowait()
+        await asyncio.sleep(0.1)
+
+async def serve(port):
+    """Запуск сервера чата без GUI."""
+    import server
+    logging.disable(logging.INFO)
+    asyncio.create_task(drain_gui_queues(server))
+    srv = await asyncio.start_server(server.handle_client_connection, BENCH_HOST, port,
+                                     limit=server.STREAM_READER_LIMIT, backlog=4096)
+    print("ready", flush=True)
+    async with srv:
+        await srv.serve_forever()
+
+async def open_client(index, port):
+    """Подключение одного клиента и ожидание входа в комнату main."""
+    source_addr = f"127.0.0.{2 + index // CLIENTS_PER_SOURCE_ADDR}"
+    reader, writer = await asyncio.open_connection(BENCH_HOST, port,
+                                                   local_addr=(source_addr, 0), limit=1024)
+    await reader.readuntil(b'\n')
+    writer.write(f"bench{index}\n".encode())
+    await reader.readuntil("комнате: main\n".encode())
+    return writer
+
+async def run_clients(server_pid, port, checkpoints):
+    """Открытие соединений и замер RSS сервера на контрольных точках."""
+    await asyncio.sleep(0.5)
+    baseline = read_rss_kib(server_pid)
+    print(f"Базовый RSS сервера: {baseline} КиБ")
+    print(f"{'клиентов':>10} {'RSS, КиБ':>12} {'на соединение, байт':>22} {'время, с':>10}")
+    writers = []
+    started = time.monotonic()
+    for target in checkpoints:
+        while len(writers) < target:
+            batch = range(len(writers), min(target, len(writers) + CONNECT_BATCH))
+            writers.extend(await asyncio.gather(*(open_client(i, port) for i in batch)))
+        # Даем серверу обработать отложенные обновления и стабилизироваться
+        await asyncio.sleep(1)
+        rss = read_rss_kib(server_pid)
+        per_conn = (rss - baseline) * 1024 / target
+        print(f"{target:>10} {rss:>12} {per_conn:>22.0f} {time.monotonic() - started:>10.1f}", flush=True)
+    for writer in writers:
+        writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер памяти сервера на простаивающих соединениях")
+    parser.add_argument('--clients', default='10000,50000,100000',
+                        help="контрольные точки числа клиентов через запятую")
+    parser.add_argument('--port', type=int, default=BENCH_PORT)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    hard_limit = raise_nofile_limit()
+
+    if args.serve:
+        asyncio.run(serve(args.port))
+        return
+
+    checkpoints = sorted(int(n) for n in args.clients.split(','))
+    if checkpoints[-1] + 100 > hard_limit:
+        sys.exit(f"Лимит дескрипторов ({hard_limit}) меньше {checkpoints[-1]} соединений; увеличьте ulimit -n.")
+
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', '--port', str(args.port)],
+                            stdout=subprocess.PIPE, text=True)
+    try:
+        if proc.stdout.readline().strip() != 'ready':
+            sys.exit("Сервер не запустился.")
+        asyncio.run(run_clients(proc.pid, args.port, checkpoints))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+if __name__ == '__main__':
+    main()
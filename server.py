@@ -1,5 +1,13 @@
 import asyncio
+import collections
+import hmac
+import os
 import signal
+import socket
+import sqlite3
+import sys
+import time
+import traceback
 import tkinter as tk
 from tkinter import scrolledtext, messagebox
 import threading
@@ -16,36 +24,447 @@ logging.basicConfig(
     ]
 )
 
+# Параметры соединений. Значения по умолчанию у asyncio рассчитаны на
+# немногочисленные «толстые» соединения; для большого числа простаивающих
+# клиентов буферы уменьшены, чтобы на одном узле помещалось больше пользователей.
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8888
+STREAM_READER_LIMIT = 16 * 1024     # предел буфера StreamReader (по умолчанию 64 КиБ)
+WRITE_BUFFER_HIGH = 16 * 1024       # верхняя граница буфера записи транспорта
+WRITE_BUFFER_LOW = 4 * 1024         # нижняя граница буфера записи транспорта
+SOCKET_RCVBUF = None                # SO_RCVBUF сокета (None - значение ядра)
+SOCKET_SNDBUF = None                # SO_SNDBUF сокета (None - значение ядра)
+MAX_NAME_SIZE = 100                 # максимальная длина имени в байтах
+MAX_MESSAGE_SIZE = 1024             # максимальный размер одного чтения сообщения
+GUI_REFRESH_INTERVAL = 0.1          # период обновления списков клиентов и комнат в GUI
+
+# Параметры почтового ящика личных сообщений для пользователей не в сети
+MAILBOX_PATH = 'mailbox.db'         # файл SQLite (None - хранение отключено)
+MAILBOX_QUOTA = 100                 # максимум сообщений в ящике одного пользователя
+MAILBOX_SENDER_QUOTA = 200          # максимум недоставленных сообщений от одного отправителя
+MAILBOX_MAX_MESSAGES = 100000       # общий предел числа сообщений в базе
+MAILBOX_TTL = 7 * 24 * 3600         # время хранения сообщения, с
+MAILBOX_EVICT_INTERVAL = 60         # период удаления просроченных сообщений, с
+MAILBOX_BATCH_SIZE = 256            # максимум операций в одной транзакции
+MAILBOX_COMMIT_INTERVAL = 0.05      # окно накопления операций перед коммитом, с
+MAILBOX_TIMEOUT = 5.0               # максимальное ожидание ответа почтового ящика, с
+
+# Параметры диагностики цикла событий
+DIAGNOSTICS_ENABLED = False         # замер задержки цикла и поиск долгих обратных вызовов
+LAG_SAMPLE_INTERVAL = 0.025         # период замера задержки цикла, с (не больше четверти порога)
+SLOW_CALLBACK_THRESHOLD = 0.1       # порог задержки для записи в лог и снятия стека, с
+PROFILER_INTERVAL = 0.005           # период выборок профилировщика, с
+PROFILE_DIR = '.'                   # каталог для файлов профилей
+ADMIN_TOKEN = None                  # секрет для команд /profile и /lag (None - команды отключены)
+
+# Параметры рассылки в больших комнатах
+BROADCAST_CHUNK_THRESHOLD = 1000    # с какого числа участников рассылка идет частями
+BROADCAST_CHUNK_SIZE = 500          # число получателей в одной части между уступками циклу
+BROADCAST_MAX_BACKLOG = 4 * WRITE_BUFFER_HIGH  # буфер записи, при котором получатель пропускается
+
+class Session:
+    """Состояние одного подключения клиента."""
+    __slots__ = (
+        'writer', 'address', 'name', 'room',
+        'messages_sent', 'messages_received', 'max_message_size',
+        'skipped_messages',
+    )
+
+    def __init__(self, writer, address, name, max_message_size=MAX_MESSAGE_SIZE):
+        self.writer = writer
+        self.address = address
+        self.name = name
+        self.room = None
+        self.messages_sent = 0
+        self.messages_received = 0
+        self.max_message_size = max_message_size
+        self.skipped_messages = 0
+
+class OfflineMailbox:
+    """Хранилище личных сообщений для пользователей не в сети.
+
+    Все операции с SQLite выполняются в отдельном потоке. Записи копятся в
+    очереди и фиксируются одной транзакцией (групповой коммит), поэтому
+    цикл событий не блокируется на fsync. Корутины ожидают результат через
+    asyncio.Future, который поток завершает после коммита.
+
+    Сообщения принимаются только для имен, которые уже входили на сервер
+    (таблица users). Имена не защищены паролем, поэтому сохраненные сообщения
+    получит любой, кто войдет под этим именем.
+
+    База открывается в конструкторе, поэтому ошибка открытия возникает сразу,
+    а не в фоновом потоке. Если поток все же падает, все последующие запросы
+    завершаются ошибкой, а ожидание ответа ограничено timeout.
+    """
+
+    def __init__(self, path=MAILBOX_PATH, quota=MAILBOX_QUOTA, ttl=MAILBOX_TTL,
+                 batch_size=MAILBOX_BATCH_SIZE, commit_interval=MAILBOX_COMMIT_INTERVAL,
+                 timeout=MAILBOX_TIMEOUT, sender_quota=MAILBOX_SENDER_QUOTA,
+                 max_messages=MAILBOX_MAX_MESSAGES, evict_interval=MAILBOX_EVICT_INTERVAL):
+        self.path = path
+        self.quota = quota
+        self.sender_quota = sender_quota
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self.evict_interval = evict_interval
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.timeout = timeout
+        self._db = self._open(path)
+        (self._total,) = self._db.execute("SELECT COUNT(*) FROM messages").fetchone()
+        self._next_eviction = 0.0
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="mailbox-writer", daemon=True)
+        self._thread.start()
+
+    async def store(self, recipient, sender, text):
+        """Сохранение сообщения.
+
+        Возвращает 'ok' или причину отказа: 'unknown_recipient' (получатель
+        никогда не входил на сервер), 'recipient_quota' (ящик получателя
+        переполнен), 'sender_quota' (у отправителя слишком много недоставленных
+        сообщений) или 'full' (достигнут общий предел базы).
+        """
+        return await self._submit('store', (recipient, sender, text, time.time()))
+
+    async def register(self, name):
+        """Запоминание имени вошедшего пользователя, чтобы принимать для него сообщения."""
+        return await self._submit('register', (name, time.time()))
+
+    async def fetch(self, recipient):
+        """Чтение непросроченных сообщений пользователя: [(id, sender, body, created_at)].
+
+        Сообщения остаются в ящике до подтверждения через ack(), поэтому
+        доставка выполняется не менее одного раза.
+        """
+        return await self._submit('fetch', (recipient, time.time() - self.ttl))
+
+    async def ack(self, message_ids):
+        """Удаление доставленных сообщений."""
+        return await self._submit('ack', tuple(message_ids))
+
+    def close(self):
+        """Фиксация оставшихся записей и остановка потока."""
+        self._requests.put(None)
+        self._thread.join()
+
+    def _submit(self, op, args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._requests.put((op, args, loop, future))
+        return asyncio.wait_for(future, self.timeout)
+
+    @staticmethod
+    def _open(path):
+        db = sqlite3.connect(path, check_same_thread=False)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=FULL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, recipient TEXT NOT NULL, "
+                "sender TEXT NOT NULL, body TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            db.execute("CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY, first_seen REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS messages_recipient ON messages (recipient, id)")
+            db.execute("CREATE INDEX IF NOT EXISTS messages_sender ON messages (sender)")
+            db.execute("CREATE INDEX IF NOT EXISTS messages_created_at ON messages (created_at)")
+            db.commit()
+        except Exception:
+            db.close()
+            raise
+        return db
+
+    @staticmethod
+    def _resolve(loop, future, result=None, error=None):
+        def apply():
+            if future.done():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        loop.call_soon_threadsafe(apply)
+
+    def _run(self):
+        try:
+            self._serve_requests()
+        except Exception as e:
+            enqueue_log(f"Почтовый ящик остановлен из-за ошибки: {e}")
+            self._fail_pending(e)
+        finally:
+            self._db.close()
+
+    def _fail_pending(self, error):
+        # После фатальной ошибки все запросы до остановки завершаются ошибкой
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            _, _, loop, future = request
+            self._resolve(loop, future, error=error)
+
+    def _serve_requests(self):
+        db = self._db
+        stopping = False
+        while not stopping:
+            # Ожидание первой операции, затем добор пакета в пределах интервала коммита
+            batch = [self._requests.get()]
+            deadline = time.monotonic() + self.commit_interval
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                stopping = True
+                batch.pop()
+            self._process_batch(db, batch)
+
+    def _process_batch(self, db, batch):
+        results = []
+        total = self._total
+        evict = time.monotonic() >= self._next_eviction
+        try:
+            with db:
+                if evict:
+                    cursor = db.execute("DELETE FROM messages WHERE created_at < ?", (time.time() - self.ttl,))
+                    total -= cursor.rowcount
+                for op, args, loop, future in batch:
+                    if future.done():
+                        # Ожидающий уже получил тайм-аут: операция не выполняется
+                        results.append(None)
+                        continue
+                    if op == 'store':
+                        results.append(self._check_quotas(db, args[0], args[1], total))
+                        if results[-1] == 'ok':
+                            db.execute(
+                                "INSERT INTO messages (recipient, sender, body, created_at) VALUES (?, ?, ?, ?)", args
+                            )
+                            total += 1
+                    elif op == 'register':
+                        db.execute("INSERT OR IGNORE INTO users (name, first_seen) VALUES (?, ?)", args)
+                        results.append(None)
+                    elif op == 'fetch':
+                        rows = db.execute(
+                            "SELECT id, sender, body, created_at FROM messages "
+                            "WHERE recipient = ? AND created_at >= ? ORDER BY id",
+                            args,
+                        ).fetchall()
+                        results.append(rows)
+                    else:
+                        cursor = db.executemany("DELETE FROM messages WHERE id = ?", [(i,) for i in args])
+                        total -= cursor.rowcount
+                        results.append(None)
+        except Exception as e:
+            for _, _, loop, future in batch:
+                self._resolve(loop, future, error=e)
+            return
+        self._total = total
+        if evict:
+            self._next_eviction = time.monotonic() + self.evict_interval
+        for (_, _, loop, future), result in zip(batch, results):
+            self._resolve(loop, future, result)
+
+    def _check_quotas(self, db, recipient, sender, total):
+        if db.execute("SELECT 1 FROM users WHERE name = ?", (recipient,)).fetchone() is None:
+            return 'unknown_recipient'
+        if total >= self.max_messages:
+            return 'full'
+        (count,) = db.execute("SELECT COUNT(*) FROM messages WHERE recipient = ?", (recipient,)).fetchone()
+        if count >= self.quota:
+            return 'recipient_quota'
+        (count,) = db.execute("SELECT COUNT(*) FROM messages WHERE sender = ?", (sender,)).fetchone()
+        if count >= self.sender_quota:
+            return 'sender_quota'
+        return 'ok'
+
+class LoopDiagnostics:
+    """Замер задержки цикла событий и обнаружение долгих обратных вызовов.
+
+    Корутина в цикле периодически засыпает и считает опоздание пробуждения
+    относительно ожидаемого времени. Период сна не больше четверти
+    slow_threshold, поэтому блокировка длиннее порога больше чем на период
+    сна всегда дает опоздание выше порога. Сторожевой поток с тем же периодом проверяет, насколько цикл
+    опаздывает прямо сейчас: после половины порога он снимает стек потока
+    цикла (код, который его удерживает), а после порога пишет его в лог. Если
+    цикл успел освободиться раньше, стек записывает сама корутина вместе с
+    задержкой.
+    """
+
+    def __init__(self, loop_thread_id, sample_interval=LAG_SAMPLE_INTERVAL, slow_threshold=SLOW_CALLBACK_THRESHOLD):
+        self.loop_thread_id = loop_thread_id
+        self.sample_interval = min(sample_interval, slow_threshold / 4)
+        self.slow_threshold = slow_threshold
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._lock = threading.Lock()
+        self._expected_wake = None   # когда корутина замера должна проснуться
+        self._stack = None           # стек, снятый для текущего ожидания
+        self._logged = False         # стек текущего ожидания уже записан в лог
+        self._stopped = threading.Event()
+        self._task = None
+        self._watchdog = None
+
+    def start(self):
+        """Запуск замеров. Вызывается из потока цикла событий."""
+        self._task = asyncio.get_running_loop().create_task(self._sample_lag())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        """Остановка замеров."""
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _sample_lag(self):
+        while True:
+            with self._lock:
+                self._expected_wake = time.monotonic() + self.sample_interval
+                self._stack = None
+                self._logged = False
+            await asyncio.sleep(self.sample_interval)
+            with self._lock:
+                lag = time.monotonic() - self._expected_wake
+                self._expected_wake = None
+                stack, logged = self._stack, self._logged
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.slow_threshold and not logged:
+                message = f"Задержка цикла событий: {lag * 1000:.1f} мс"
+                if stack:
+                    message += f". Стек:\n{stack.rstrip()}"
+                enqueue_log(message)
+
+    def _watch(self):
+        while not self._stopped.wait(self.sample_interval):
+            with self._lock:
+                if self._expected_wake is None or self._logged:
+                    continue
+                stalled = time.monotonic() - self._expected_wake
+                if stalled > self.slow_threshold / 2 and self._stack is None:
+                    # Цикл занят: стек потока цикла указывает на блокирующий код
+                    frame = sys._current_frames().get(self.loop_thread_id)
+                    self._stack = "".join(traceback.format_stack(frame)) if frame else "стек недоступен\n"
+                if stalled <= self.slow_threshold:
+                    continue
+                self._logged = True
+                stack = self._stack
+            enqueue_log(f"Цикл событий не отвечает {stalled * 1000:.0f} мс. Стек:\n{stack.rstrip()}")
+
+class SamplingProfiler:
+    """Выборочный профилировщик потока цикла событий.
+
+    Фоновый поток с заданным интервалом снимает стек потока цикла и считает
+    одинаковые стеки. Результат сохраняется в свернутом формате
+    (collapsed stacks), который принимают flamegraph.pl и speedscope.
+    """
+
+    def __init__(self, thread_id, interval=PROFILER_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self._stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        """Запуск сбора выборок."""
+        self._thread.start()
+
+    def stop(self, path):
+        """Остановка сбора и запись свернутых стеков в файл."""
+        self._stopped.set()
+        self._thread.join()
+        with open(path, 'w') as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self._stacks[";".join(reversed(names))] += 1
+            self.samples += 1
+
 # Словари для хранения подключенных клиентов и комнат чата
-connected_clients = {}
+connected_clients = {}    # StreamWriter -> Session
+clients_by_name = {}      # имя -> Session
 chat_rooms = {'main': set()}
 
+# Фоновые задачи (ссылки хранятся, чтобы задачи не были собраны сборщиком мусора)
+background_tasks = set()
+
+# Адрес, на котором слушает запущенный сервер (при port=0 порт выбирает система)
+server_address = None
+
+# Почтовый ящик для личных сообщений пользователям не в сети
+mailbox = None
+
+# Диагностика цикла событий и профилировщик
+loop_thread_id = None
+diagnostics = None
+profiler = None
+profiler_lock = threading.RLock()
+
 # Очереди для передачи сообщений в основной поток GUI
 client_list_queue = queue.Queue()
 room_list_queue = queue.Queue()
 log_queue = queue.Queue()
 
+# Флаги отложенного обновления списков для GUI
+_client_list_pending = False
+_room_list_pending = False
+
 def enqueue_log(message):
     """Добавление сообщений в очередь логов и логирование."""
     log_queue.put(message)
     logging.info(message)
 
-def enqueue_client_list():
-    """Обновление списка клиентов."""
-    client_list = []
-    for writer, name in connected_clients.items():
-        addr = writer.get_extra_info('peername')
-        client_list.append(f"{name} ({addr})")
+def _flush_client_list():
+    """Формирование списка клиентов для GUI."""
+    global _client_list_pending
+    _client_list_pending = False
+    client_list = [f"{session.name} ({session.address})" for session in connected_clients.values()]
     client_list_queue.put(client_list)
 
-def enqueue_room_list():
-    """Обновление списка комнат."""
-    room_list = []
-    for room, clients in chat_rooms.items():
-        room_list.append(f"{room} ({len(clients)} участников)")
+def _flush_room_list():
+    """Формирование списка комнат для GUI."""
+    global _room_list_pending
+    _room_list_pending = False
+    room_list = [f"{room} ({len(clients)} участников)" for room, clients in chat_rooms.items()]
     room_list_queue.put(room_list)
 
-def update_widgets(client_list_widget, room_list_widget, log_widget):
+def enqueue_client_list():
+    """Обновление списка клиентов.
+
+    Список строится не чаще раза в GUI_REFRESH_INTERVAL, чтобы массовые
+    подключения не приводили к квадратичной работе.
+    """
+    global _client_list_pending
+    if not _client_list_pending:
+        _client_list_pending = True
+        asyncio.get_running_loop().call_later(GUI_REFRESH_INTERVAL, _flush_client_list)
+
+def enqueue_room_list():
+    """Обновление списка комнат (не чаще раза в GUI_REFRESH_INTERVAL)."""
+    global _room_list_pending
+    if not _room_list_pending:
+        _room_list_pending = True
+        asyncio.get_running_loop().call_later(GUI_REFRESH_INTERVAL, _flush_room_list)
+
+def update_widgets(client_list_widget, room_list_widget, log_widget, profile_button):
     """Обновление виджетов GUI из очередей."""
     # Обновление логов
     while not log_queue.empty():
@@ -69,103 +488,253 @@ def update_widgets(client_list_widget, room_list_widget, log_widget):
         for room in room_list:
             room_list_widget.insert(tk.END, room)
 
+    # Состояние кнопки профилирования (профилировщик могут переключать и командой /profile)
+    profile_text = "Запустить профилирование" if profiler is None else "Остановить профилирование"
+    if profile_button.cget('text') != profile_text:
+        profile_button.config(text=profile_text)
+
     # Запланировать следующий вызов через 100 мс
-    root.after(100, update_widgets, client_list_widget, room_list_widget, log_widget)
+    root.after(100, update_widgets, client_list_widget, room_list_widget, log_widget, profile_button)
 
 def get_current_room(writer):
     """Получение текущей комнаты клиента."""
-    for room_name, clients in chat_rooms.items():
-        if writer in clients:
-            return room_name
-    return None
+    session = connected_clients.get(writer)
+    return session.room if session else None
+
+def add_to_room(session, room_name):
+    """Добавление клиента в комнату (комната создается при необходимости)."""
+    chat_rooms.setdefault(room_name, set()).add(session.writer)
+    session.room = room_name
+
+def remove_from_room(session):
+    """Удаление клиента из текущей комнаты. Возвращает имя покинутой комнаты."""
+    room_name = session.room
+    if room_name is None:
+        return None
+    session.room = None
+    clients = chat_rooms.get(room_name)
+    if clients is not None:
+        clients.discard(session.writer)
+        if not clients:
+            del chat_rooms[room_name]
+            enqueue_log(f"Комната '{room_name}' удалена, так как в ней больше нет участников.")
+    return room_name
+
+def configure_connection(writer, write_buffer_high=WRITE_BUFFER_HIGH, write_buffer_low=WRITE_BUFFER_LOW,
+                         rcvbuf=SOCKET_RCVBUF, sndbuf=SOCKET_SNDBUF):
+    """Настройка буферов транспорта и сокета нового соединения."""
+    writer.transport.set_write_buffer_limits(high=write_buffer_high, low=write_buffer_low)
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        if sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
 
 async def broadcast_message(sender_writer, message, room_name):
     """Рассылка сообщения всем клиентам в комнате, кроме отправителя."""
     if room_name in chat_rooms:
+        connected_clients[sender_writer].messages_sent += 1
+        if len(chat_rooms[room_name]) >= BROADCAST_CHUNK_THRESHOLD:
+            await broadcast_large_room(sender_writer, message, room_name)
+            return
+        data = message.encode()
         for client_writer in chat_rooms[room_name]:
             if client_writer != sender_writer:
+                session = connected_clients.get(client_writer)
                 try:
-                    client_writer.write(message.encode())
+                    client_writer.write(data)
                     await client_writer.drain()
-                    enqueue_log(f"Отправлено сообщение клиенту {connected_clients[client_writer]}: {message.strip()}")
+                    session.messages_received += 1
+                    enqueue_log(f"Отправлено сообщение клиенту {session.name}: {message.strip()}")
                 except Exception as e:
-                    enqueue_log(f"Ошибка при отправке сообщения клиенту {connected_clients.get(client_writer, 'Неизвестный')}: {e}")
+                    enqueue_log(f"Ошибка при отправке сообщения клиенту {session.name if session else 'Неизвестный'}: {e}")
     else:
         sender_writer.write("Комната не найдена.\n".encode())
         await sender_writer.drain()
-        enqueue_log(f"Комната '{room_name}' не найдена при попытке отправки сообщения клиенту {connected_clients[sender_writer]}.")
+        enqueue_log(f"Комната '{room_name}' не найдена при попытке отправки сообщения клиенту {connected_clients[sender_writer].name}.")
+
+async def broadcast_large_room(sender_writer, message, room_name):
+    """Рассылка в большой комнате частями с уступкой циклу событий между ними.
+
+    Сообщение кодируется один раз, а запись идет частями по
+    BROADCAST_CHUNK_SIZE получателей без ожидания drain, чтобы рассылка не
+    задерживала другие соединения. Получатели, у которых буфер
+    записи превысил BROADCAST_MAX_BACKLOG, пропускаются: медленный клиент
+    не может неограниченно увеличивать память сервера. Пропуски считаются,
+    и после освобождения буфера клиент получает одно уведомление с их
+    числом; до этого новые сообщения ему тоже не отправляются, чтобы
+    уведомление стояло на месте пропуска.
+    """
+    data = message.encode()
+    # Снимок состава комнаты: между частями участники могут входить и выходить
+    recipients = list(chat_rooms.get(room_name, ()))
+    delivered = failed = 0
+    slow = []
+    for start in range(0, len(recipients), BROADCAST_CHUNK_SIZE):
+        for client_writer in recipients[start:start + BROADCAST_CHUNK_SIZE]:
+            if client_writer is sender_writer:
+                continue
+            session = connected_clients.get(client_writer)
+            if session is None or client_writer.is_closing():
+                continue
+            if session.skipped_messages or client_writer.transport.get_write_buffer_size() > BROADCAST_MAX_BACKLOG:
+                slow.append(session.name)
+                failed += 1
+                session.skipped_messages += 1
+                if session.skipped_messages == 1:
+                    task = asyncio.create_task(notify_skipped_messages(session))
+                    background_tasks.add(task)
+                    task.add_done_callback(background_tasks.discard)
+                continue
+            try:
+                client_writer.write(data)
+                session.messages_received += 1
+                delivered += 1
+            except Exception:
+                failed += 1
+        await asyncio.sleep(0)
+    enqueue_log(f"Сообщение разослано {delivered} клиентам комнаты '{room_name}' (ошибок: {failed}): {message.strip()}")
+    if slow:
+        enqueue_log(f"Пропущены медленные клиенты комнаты '{room_name}' ({len(slow)}): {', '.join(slow[:10])}")
+
+async def notify_skipped_messages(session):
+    """Уведомление медленного клиента о пропущенных сообщениях после освобождения буфера."""
+    try:
+        await session.writer.drain()
+    except Exception:
+        return
+    count, session.skipped_messages = session.skipped_messages, 0
+    if session.writer.is_closing():
+        return
+    session.writer.write(f"Пропущено сообщений из-за медленного соединения: {count}\n".encode())
+    enqueue_log(f"Клиенту {session.name} отправлено уведомление о {count} пропущенных сообщениях.")
 
 async def send_private_message(sender_writer, target_name, message):
     """Отправка личного сообщения конкретному пользователю."""
-    target_writer = next((w for w, name in connected_clients.items() if name == target_name), None)
-    if target_writer:
+    sender = connected_clients[sender_writer]
+    target = clients_by_name.get(target_name)
+    if target:
         try:
-            sender_name = connected_clients[sender_writer]
             # Отправка сообщения самому себе
             sender_writer.write(f"Вы отправили личное сообщение {target_name}: {message}\n".encode())
             await sender_writer.drain()
-            enqueue_log(f"Отправлено сообщение самому себе клиенту {sender_name}: {message}")
+            enqueue_log(f"Отправлено сообщение самому себе клиенту {sender.name}: {message}")
 
             # Отправка сообщения получателю
-            target_writer.write(f"Личное сообщение от {sender_name}: {message}\n".encode())
-            await target_writer.drain()
+            target.writer.write(f"Личное сообщение от {sender.name}: {message}\n".encode())
+            await target.writer.drain()
+            sender.messages_sent += 1
+            target.messages_received += 1
             enqueue_log(f"Отправлено личное сообщение клиенту {target_name}: {message}")
 
             # Логирование
-            enqueue_log(f"{sender_name} отправил личное сообщение {target_name}: {message}")
+            enqueue_log(f"{sender.name} отправил личное сообщение {target_name}: {message}")
         except Exception as e:
-            enqueue_log(f"Ошибка при отправке личного сообщения от {connected_clients.get(sender_writer, 'Неизвестный')} к {target_name}: {e}")
+            enqueue_log(f"Ошибка при отправке личного сообщения от {sender.name} к {target_name}: {e}")
+    elif mailbox is not None:
+        await store_offline_message(sender, target_name, message)
     else:
         sender_writer.write("Пользователь не найден\n".encode())
         await sender_writer.drain()
-        enqueue_log(f"Клиент {connected_clients[sender_writer]} попытался отправить личное сообщение несуществующему пользователю {target_name}.")
+        enqueue_log(f"Клиент {sender.name} попытался отправить личное сообщение несуществующему пользователю {target_name}.")
+
+async def store_offline_message(sender, target_name, message):
+    """Сохранение личного сообщения для пользователя не в сети."""
+    try:
+        stored = await mailbox.store(target_name, sender.name, message)
+    except asyncio.TimeoutError:
+        stored = 'timeout'
+        enqueue_log(f"Тайм-аут при сохранении сообщения от {sender.name} для {target_name}.")
+    except Exception as e:
+        stored = None
+        enqueue_log(f"Ошибка при сохранении сообщения от {sender.name} для {target_name}: {e}")
+    if stored == 'ok':
+        sender.messages_sent += 1
+        sender.writer.write(f"Пользователь {target_name} не в сети. Сообщение будет доставлено при входе.\n".encode())
+        enqueue_log(f"Сохранено личное сообщение от {sender.name} для {target_name} (не в сети).")
+    elif stored is None:
+        sender.writer.write("Не удалось сохранить сообщение.\n".encode())
+    elif stored == 'timeout':
+        # Запись могла быть зафиксирована, если тайм-аут совпал с коммитом
+        sender.writer.write("Сохранение сообщения не подтверждено. Оно может быть доставлено, не отправляйте его повторно.\n".encode())
+    else:
+        if stored == 'unknown_recipient':
+            reply = "Пользователь не найден\n"
+        elif stored == 'recipient_quota':
+            reply = f"Почтовый ящик пользователя {target_name} переполнен.\n"
+        elif stored == 'sender_quota':
+            reply = "У вас слишком много недоставленных сообщений. Попробуйте позже.\n"
+        else:
+            reply = "Хранилище сообщений переполнено. Попробуйте позже.\n"
+        sender.writer.write(reply.encode())
+        enqueue_log(f"Сообщение от {sender.name} для {target_name} не сохранено: {stored}.")
+    await sender.writer.drain()
+
+async def deliver_offline_messages(session):
+    """Доставка накопленных личных сообщений одним пакетом при входе."""
+    if mailbox is None:
+        return
+    try:
+        _, rows = await asyncio.gather(mailbox.register(session.name), mailbox.fetch(session.name))
+    except Exception as e:
+        enqueue_log(f"Ошибка при чтении почтового ящика {session.name}: {e}")
+        return
+    if not rows:
+        return
+    lines = [f"У вас {len(rows)} непрочитанных личных сообщений:\n"]
+    for _, sender_name, body, created_at in rows:
+        sent_at = time.strftime('%Y-%m-%d %H:%M', time.localtime(created_at))
+        lines.append(f"[{sent_at}] Личное сообщение от {sender_name}: {body}\n")
+    session.writer.write("".join(lines).encode())
+    await session.writer.drain()
+    session.messages_received += len(rows)
+    enqueue_log(f"Доставлено {len(rows)} отложенных личных сообщений клиенту {session.name}.")
+    # Удаление только после успешной отправки: при обрыве сообщения будут доставлены при следующем входе
+    try:
+        await mailbox.ack(row[0] for row in rows)
+    except Exception as e:
+        enqueue_log(f"Ошибка при подтверждении доставки сообщений {session.name}: {e}")
 
 async def join_room(writer, room_name):
     """Присоединение клиента к комнате."""
-    current_room = get_current_room(writer)
-    if current_room:
-        chat_rooms[current_room].remove(writer)
-        if not chat_rooms[current_room]:
-            del chat_rooms[current_room]
-            enqueue_log(f"Комната '{current_room}' удалена, так как в ней больше нет участников.")
+    session = connected_clients[writer]
+    remove_from_room(session)
     if room_name not in chat_rooms:
-        chat_rooms[room_name] = set()
         enqueue_log(f"Комната '{room_name}' создана автоматически при присоединении.")
-    chat_rooms[room_name].add(writer)
+    add_to_room(session, room_name)
     writer.write(f"Вы присоединились к комнате: {room_name}\n".encode())
     await writer.drain()
-    enqueue_log(f"Отправлено сообщение о присоединении к комнате '{room_name}' клиенту {connected_clients[writer]}.")
+    enqueue_log(f"Отправлено сообщение о присоединении к комнате '{room_name}' клиенту {session.name}.")
     enqueue_room_list()
 
 async def create_room(writer, room_name):
     """Создание новой комнаты."""
+    client_name = connected_clients[writer].name
     if room_name in chat_rooms:
         writer.write(f"Комната '{room_name}' уже существует.\n".encode())
         await writer.drain()
-        enqueue_log(f"Клиент {connected_clients[writer]} попытался создать существующую комнату '{room_name}'.")
+        enqueue_log(f"Клиент {client_name} попытался создать существующую комнату '{room_name}'.")
     else:
         chat_rooms[room_name] = set()
         writer.write(f"Комната '{room_name}' создана.\n".encode())
         await writer.drain()
-        enqueue_log(f"Клиент {connected_clients[writer]} создал комнату: {room_name}")
+        enqueue_log(f"Клиент {client_name} создал комнату: {room_name}")
         enqueue_room_list()
 
 async def leave_room(writer):
     """Покидание текущей комнаты."""
-    current_room = get_current_room(writer)
+    session = connected_clients[writer]
+    current_room = remove_from_room(session)
     if current_room:
-        chat_rooms[current_room].remove(writer)
-        if not chat_rooms[current_room]:
-            del chat_rooms[current_room]
-            enqueue_log(f"Комната '{current_room}' удалена, так как в ней больше нет участников.")
         writer.write(f"Вы покинули комнату: {current_room}\n".encode())
         await writer.drain()
-        enqueue_log(f"Отправлено сообщение о покидании комнаты '{current_room}' клиенту {connected_clients[writer]}.")
+        enqueue_log(f"Отправлено сообщение о покидании комнаты '{current_room}' клиенту {session.name}.")
         enqueue_room_list()
     else:
         writer.write("Вы не находитесь в какой-либо комнате.\n".encode())
         await writer.drain()
-        enqueue_log(f"Клиент {connected_clients[writer]} попытался покинуть комнату, в которой не находится.")
+        enqueue_log(f"Клиент {session.name} попытался покинуть комнату, в которой не находится.")
 
 async def list_rooms(writer):
     """Отправка списка доступных комнат."""
@@ -175,7 +744,7 @@ async def list_rooms(writer):
         rooms_list = "Нет доступных комнат.\n"
     writer.write(rooms_list.encode())
     await writer.drain()
-    enqueue_log(f"Отправлен список комнат клиенту {connected_clients[writer]}.")
+    enqueue_log(f"Отправлен список комнат клиенту {connected_clients[writer].name}.")
 
 async def show_current_chat(writer):
     """Отправка информации о текущей комнате."""
@@ -185,17 +754,17 @@ async def show_current_chat(writer):
     else:
         writer.write("Вы не находитесь в какой-либо комнате.\n".encode())
     await writer.drain()
-    enqueue_log(f"Отправлено сообщение о текущей комнате клиенту {connected_clients[writer]}.")
+    enqueue_log(f"Отправлено сообщение о текущей комнате клиенту {connected_clients[writer].name}.")
 
 async def list_users(writer):
     """Отправка списка подключённых пользователей."""
-    if connected_clients:
-        users_list = "Список пользователей: " + ", ".join(connected_clients.values()) + "\n"
+    if clients_by_name:
+        users_list = "Список пользователей: " + ", ".join(clients_by_name) + "\n"
     else:
         users_list = "Нет подключенных пользователей.\n"
     writer.write(users_list.encode())
     await writer.drain()
-    enqueue_log(f"Отправлен список пользователей клиенту {connected_clients[writer]}.")
+    enqueue_log(f"Отправлен список пользователей клиенту {connected_clients[writer].name}.")
 
 async def show_help(writer):
     """Отправка списка доступных команд."""
@@ -208,10 +777,104 @@ async def show_help(writer):
         "/currentchat - показать текущую комнату\n"
         "/listrooms - показать список комнат\n"
         "/upload <filename> - загрузить файл\n"
+        "/profile <token> start|stop - профилирование сервера (для администраторов)\n"
+        "/lag <token> - задержка цикла событий (для администраторов)\n"
     )
     writer.write(help_message.encode())
     await writer.drain()
-    enqueue_log(f"Отправлено сообщение о командах клиенту {connected_clients[writer]}.")
+    enqueue_log(f"Отправлено сообщение о командах клиенту {connected_clients[writer].name}.")
+
+def start_profiling():
+    """Запуск профилировщика потока цикла событий. Возвращает False, если он уже запущен."""
+    global profiler
+    with profiler_lock:
+        if profiler is not None or loop_thread_id is None:
+            return False
+        profiler = SamplingProfiler(loop_thread_id)
+        profiler.start()
+    enqueue_log("Профилирование цикла событий запущено.")
+    return True
+
+def _detach_profiler():
+    """Отсоединение текущего профилировщика. Вызывается под profiler_lock."""
+    global profiler
+    current, profiler = profiler, None
+    return current
+
+def _save_profile(current):
+    """Остановка отсоединенного профилировщика и запись профиля вне блокировки."""
+    path = os.path.join(PROFILE_DIR, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+    current.stop(path)
+    enqueue_log(f"Профилирование остановлено: {current.samples} выборок записано в {path}.")
+    return path
+
+def stop_profiling():
+    """Остановка профилировщика и запись профиля. Возвращает путь к файлу или None."""
+    with profiler_lock:
+        current = _detach_profiler()
+    return _save_profile(current) if current else None
+
+def toggle_profiling():
+    """Атомарное переключение профилировщика.
+
+    Возвращает ('started', None), ('stopped', путь) или ('unavailable', None),
+    если сервер еще не запущен. Под блокировкой принимается только решение;
+    ожидание потока выборок и запись файла выполняются после нее, чтобы не
+    задерживать /profile в цикле событий.
+    """
+    with profiler_lock:
+        if profiler is None:
+            return ('started', None) if start_profiling() else ('unavailable', None)
+        current = _detach_profiler()
+    return 'stopped', _save_profile(current)
+
+async def check_admin(writer, token):
+    """Проверка секрета администратора с сообщением клиенту при отказе.
+
+    Имена пользователей не защищены, поэтому права определяются только
+    знанием ADMIN_TOKEN, а не именем.
+    """
+    session = connected_clients[writer]
+    if ADMIN_TOKEN and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return True
+    writer.write("Команда доступна только администраторам.\n".encode())
+    await writer.drain()
+    enqueue_log(f"Клиент {session.name} попытался выполнить команду администратора.")
+    return False
+
+async def handle_profile_command(writer, args):
+    """Запуск и остановка профилировщика по команде администратора."""
+    token, _, action = args.partition(' ')
+    if not await check_admin(writer, token):
+        return
+    if action == 'start':
+        if start_profiling():
+            writer.write("Профилирование запущено.\n".encode())
+        else:
+            writer.write("Профилирование уже запущено.\n".encode())
+    elif action == 'stop':
+        # Запись файла профиля выполняется вне цикла событий
+        path = await asyncio.to_thread(stop_profiling)
+        if path:
+            writer.write(f"Профиль сохранен в {path}\n".encode())
+        else:
+            writer.write("Профилирование не запущено.\n".encode())
+    else:
+        writer.write("Использование: /profile <token> start|stop\n".encode())
+    await writer.drain()
+
+async def show_loop_lag(writer, token):
+    """Отправка статистики задержки цикла событий администратору."""
+    if not await check_admin(writer, token):
+        return
+    if diagnostics is None:
+        writer.write("Диагностика цикла событий отключена.\n".encode())
+    else:
+        writer.write(
+            f"Задержка цикла: текущая {diagnostics.last_lag * 1000:.1f} мс, "
+            f"максимальная {diagnostics.max_lag * 1000:.1f} мс\n".encode()
+        )
+    await writer.drain()
 
 async def upload_file(reader, writer, filename):
     """Обработка загрузки файла от клиента."""
@@ -223,7 +886,7 @@ async def upload_file(reader, writer, filename):
         data = await reader.readuntil(b'\n')
         filesize_str = data.decode().strip()
         filesize = int(filesize_str)
-        enqueue_log(f"Получение файла '{filename}' размером {filesize} байт от {connected_clients[writer]}.")
+        enqueue_log(f"Получение файла '{filename}' размером {filesize} байт от {connected_clients[writer].name}.")
 
         # Прием содержимого файла
         with open(f"received_{filename}", 'wb') as f:
@@ -241,12 +904,13 @@ async def upload_file(reader, writer, filename):
     except Exception as e:
         writer.write(f"Ошибка при загрузке файла: {e}\n".encode())
         await writer.drain()
-        enqueue_log(f"Ошибка при загрузке файла '{filename}' от {connected_clients[writer]}: {e}")
+        enqueue_log(f"Ошибка при загрузке файла '{filename}' от {connected_clients[writer].name}: {e}")
 
 async def handle_client_connection(reader, writer):
     """Обработка подключения клиента."""
     client_address = writer.get_extra_info('peername')
     enqueue_log(f"Подключение от: {client_address}")
+    configure_connection(writer)
 
     try:
         # Запрос имени клиента
@@ -255,7 +919,7 @@ async def handle_client_connection(reader, writer):
         enqueue_log(f"Отправлено приглашение ввести имя клиенту {client_address}.")
 
         # Получение имени клиента
-        data = await reader.read(100)
+        data = await reader.read(MAX_NAME_SIZE)
         if not data:
             raise ConnectionResetError("Клиент закрыл соединение перед отправкой имени.")
         client_name = data.decode().strip()
@@ -266,15 +930,17 @@ async def handle_client_connection(reader, writer):
             raise ValueError("Имя клиента не указано.")
 
         # Проверка уникальности имени
-        if client_name in connected_clients.values():
+        if client_name in clients_by_name:
             writer.write("Это имя уже занято. Закрытие соединения.\n".encode())
             await writer.drain()
             enqueue_log(f"Клиент {client_address} попытался использовать занятое имя '{client_name}'. Закрытие соединения.")
             raise ValueError("Имя клиента уже занято.")
 
         # Добавление клиента в список и основную комнату
-        connected_clients[writer] = client_name
-        chat_rooms['main'].add(writer)
+        session = Session(writer, client_address, client_name)
+        connected_clients[writer] = session
+        clients_by_name[client_name] = session
+        add_to_room(session, 'main')
         enqueue_client_list()
         enqueue_room_list()
 
@@ -289,16 +955,22 @@ async def handle_client_connection(reader, writer):
         await writer.drain()
         enqueue_log(f"Отправлено сообщение о присоединении к комнате main клиенту {client_name}.")
 
+        await deliver_offline_messages(session)
+
         while True:
             # Чтение сообщения от клиента
-            message = await reader.read(1024)
+            message = await reader.read(session.max_message_size)
             if not message:
                 # Клиент отключился
                 enqueue_log(f"Клиент {client_name} отключился.")
                 break
             decoded_message = message.decode().strip()
-            current_room = get_current_room(writer)
-            enqueue_log(f"{client_name}@{current_room}: {decoded_message}")
+            current_room = session.room
+            if decoded_message.startswith(('/profile', '/lag')):
+                # Секрет администратора не попадает в лог
+                enqueue_log(f"{client_name}@{current_room}: {decoded_message.split(maxsplit=1)[0]} ***")
+            else:
+                enqueue_log(f"{client_name}@{current_room}: {decoded_message}")
 
             # Обработка команд
             if decoded_message.startswith('/join'):
@@ -347,6 +1019,14 @@ async def handle_client_connection(reader, writer):
             elif decoded_message.startswith('/help'):
                 await show_help(writer)
 
+            elif decoded_message.startswith('/profile'):
+                parts = decoded_message.split(maxsplit=1)
+                await handle_profile_command(writer, parts[1].strip() if len(parts) > 1 else '')
+
+            elif decoded_message.startswith('/lag'):
+                parts = decoded_message.split(maxsplit=1)
+                await show_loop_lag(writer, parts[1].strip() if len(parts) > 1 else '')
+
             elif decoded_message.startswith('/upload'):
                 # Обработка загрузки файла
                 parts = decoded_message.split(maxsplit=1)
@@ -375,8 +1055,13 @@ async def handle_client_connection(reader, writer):
 
 async def disconnect_client(writer, client_address):
     """Отключение клиента и очистка данных."""
-    client_name = connected_clients.pop(writer, "Неизвестный")
-    await leave_room(writer)
+    session = connected_clients.pop(writer, None)
+    client_name = "Неизвестный"
+    if session:
+        client_name = session.name
+        if clients_by_name.get(client_name) is session:
+            del clients_by_name[client_name]
+        remove_from_room(session)
     try:
         writer.close()
         await writer.wait_closed()
@@ -387,12 +1072,33 @@ async def disconnect_client(writer, client_address):
     enqueue_client_list()
     enqueue_room_list()
 
-async def start_server():
+async def start_server(host=SERVER_HOST, port=SERVER_PORT, reader_limit=STREAM_READER_LIMIT,
+                       mailbox_path=MAILBOX_PATH, diagnostics_enabled=DIAGNOSTICS_ENABLED):
     """Запуск сервера."""
-    server = await asyncio.start_server(handle_client_connection, '127.0.0.1', 8888)
-    enqueue_log("Сервер запущен и слушает порт 8888")
-    async with server:
-        await server.serve_forever()
+    global mailbox, loop_thread_id, diagnostics, server_address
+    loop_thread_id = threading.get_ident()
+    if diagnostics_enabled:
+        diagnostics = LoopDiagnostics(loop_thread_id)
+        diagnostics.start()
+    if mailbox_path:
+        try:
+            mailbox = OfflineMailbox(mailbox_path)
+        except Exception as e:
+            enqueue_log(f"Не удалось открыть почтовый ящик '{mailbox_path}', хранение сообщений отключено: {e}")
+    server = await asyncio.start_server(handle_client_connection, host, port, limit=reader_limit)
+    server_address = server.sockets[0].getsockname()
+    enqueue_log(f"Сервер запущен и слушает порт {server_address[1]}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        server_address = None
+        if diagnostics is not None:
+            diagnostics.stop()
+            diagnostics = None
+        if mailbox is not None:
+            mailbox.close()
+            mailbox = None
 
 def server_thread():
     """Запуск серверного цикла в отдельном потоке."""
@@ -408,6 +1114,18 @@ def handle_exit(signum, frame):
     loop = asyncio.get_event_loop()
     loop.call_soon_threadsafe(loop.stop)
 
+def on_toggle_profiling():
+    """Запуск или остановка профилировщика из окна сервера."""
+    state, path = toggle_profiling()
+    if state == 'unavailable':
+        messagebox.showerror("Ошибка", "Сервер еще не запущен.")
+    elif state == 'started':
+        profile_button.config(text="Остановить профилирование")
+    else:
+        profile_button.config(text="Запустить профилирование")
+        if path:
+            messagebox.showinfo("Профилирование", f"Профиль сохранен в {path}")
+
 if __name__ == '__main__':
     # Создание окна сервера
     root = tk.Tk()
@@ -452,6 +1170,10 @@ if __name__ == '__main__':
     log_widget = scrolledtext.ScrolledText(logs_frame, wrap=tk.WORD, width=60, height=30, state='disabled', bg="#FFFDE7", fg="#000000")
     log_widget.pack(fill=tk.BOTH, expand=True)
 
+    # Кнопка профилирования цикла событий
+    profile_button = tk.Button(logs_frame, text="Запустить профилирование", command=on_toggle_profiling)
+    profile_button.pack(pady=(5,0))
+
     # Запуск серверного потока
     threading.Thread(target=server_thread, daemon=True).start()
 
@@ -460,7 +1182,7 @@ if __name__ == '__main__':
     signal.signal(signal.SIGTERM, handle_exit)
 
     # Запуск периодического обновления виджетов
-    root.after(100, update_widgets, client_list_widget, room_list_widget, log_widget)
+    root.after(100, update_widgets, client_list_widget, room_list_widget, log_widget, profile_button)
 
     # Запуск GUI
     root.mainloop()
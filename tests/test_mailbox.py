@@ -0,0 +1,179 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+import server
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "mailbox.db")
+
+
+def make_mailbox(db_path, users=('bob', 'dave', 'u1', 'u2', 'u3', 'u4'), **kwargs):
+    kwargs.setdefault('commit_interval', 0.001)
+    kwargs.setdefault('timeout', 2.0)
+    mailbox = server.OfflineMailbox(db_path, **kwargs)
+
+    async def register_users():
+        await asyncio.gather(*(mailbox.register(user) for user in users))
+
+    run(register_users())
+    return mailbox
+
+
+def count_rows(db_path):
+    with sqlite3.connect(db_path) as db:
+        return db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+
+def test_store_fetch_ack(db_path):
+    mailbox = make_mailbox(db_path)
+
+    async def scenario():
+        assert await mailbox.store('bob', 'alice', 'привет') == 'ok'
+        assert await mailbox.store('bob', 'carol', 'как дела?') == 'ok'
+        rows = await mailbox.fetch('bob')
+        assert [(sender, body) for _, sender, body, _ in rows] == [('alice', 'привет'), ('carol', 'как дела?')]
+        # До подтверждения сообщения остаются в ящике
+        assert len(await mailbox.fetch('bob')) == 2
+        await mailbox.ack(row[0] for row in rows)
+        assert await mailbox.fetch('bob') == []
+
+    try:
+        run(scenario())
+    finally:
+        mailbox.close()
+    assert count_rows(db_path) == 0
+
+
+def test_unknown_recipient_rejected_until_registered(db_path):
+    mailbox = make_mailbox(db_path, users=())
+
+    async def scenario():
+        assert await mailbox.store('nobody', 'alice', 'привет') == 'unknown_recipient'
+        await mailbox.register('nobody')
+        assert await mailbox.store('nobody', 'alice', 'привет') == 'ok'
+
+    try:
+        run(scenario())
+    finally:
+        mailbox.close()
+    assert count_rows(db_path) == 1
+
+
+def test_recipient_quota(db_path):
+    mailbox = make_mailbox(db_path, quota=2)
+
+    async def scenario():
+        assert await mailbox.store('bob', 'alice', '1') == 'ok'
+        assert await mailbox.store('bob', 'alice', '2') == 'ok'
+        assert await mailbox.store('bob', 'alice', '3') == 'recipient_quota'
+        assert await mailbox.store('dave', 'alice', '4') == 'ok'
+
+    try:
+        run(scenario())
+    finally:
+        mailbox.close()
+    assert count_rows(db_path) == 3
+
+
+def test_sender_quota_and_global_cap(db_path):
+    mailbox = make_mailbox(db_path, sender_quota=2, max_messages=3)
+
+    async def scenario():
+        assert await mailbox.store('u1', 'spammer', 'x') == 'ok'
+        assert await mailbox.store('u2', 'spammer', 'x') == 'ok'
+        assert await mailbox.store('u3', 'spammer', 'x') == 'sender_quota'
+        assert await mailbox.store('u3', 'alice', 'x') == 'ok'
+        assert await mailbox.store('u4', 'carol', 'x') == 'full'
+
+    try:
+        run(scenario())
+    finally:
+        mailbox.close()
+
+
+def test_ttl_eviction(db_path):
+    mailbox = make_mailbox(db_path, ttl=0.2, evict_interval=0)
+
+    async def scenario():
+        assert await mailbox.store('bob', 'alice', 'старое') == 'ok'
+        await asyncio.sleep(0.3)
+        # Просроченное сообщение не выдается и удаляется при следующем пакете
+        assert await mailbox.fetch('bob') == []
+        assert await mailbox.store('bob', 'alice', 'новое') == 'ok'
+
+    try:
+        run(scenario())
+    finally:
+        mailbox.close()
+    assert count_rows(db_path) == 1
+
+
+def test_timed_out_store_is_not_committed(db_path, monkeypatch):
+    process_batch = server.OfflineMailbox._process_batch
+
+    def slow_process_batch(self, db, batch):
+        time.sleep(0.3)
+        process_batch(self, db, batch)
+
+    mailbox = make_mailbox(db_path, timeout=0.1)
+    monkeypatch.setattr(server.OfflineMailbox, '_process_batch', slow_process_batch)
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await mailbox.store('bob', 'alice', 'привет')
+
+    try:
+        run(scenario())
+    finally:
+        mailbox.close()
+    assert count_rows(db_path) == 0
+
+
+def test_open_failure_raises(tmp_path):
+    with pytest.raises(sqlite3.Error):
+        server.OfflineMailbox(str(tmp_path / "missing" / "mailbox.db"))
+
+
+def test_writer_thread_failure_fails_requests(db_path, monkeypatch):
+    def broken(self):
+        raise RuntimeError("диск недоступен")
+
+    monkeypatch.setattr(server.OfflineMailbox, '_serve_requests', broken)
+    mailbox = make_mailbox(db_path, users=())
+
+    async def scenario():
+        started = time.monotonic()
+        with pytest.raises(RuntimeError):
+            await mailbox.store('bob', 'alice', 'привет')
+        with pytest.raises(RuntimeError):
+            await mailbox.fetch('bob')
+        assert time.monotonic() - started < mailbox.timeout
+
+    try:
+        run(scenario())
+    finally:
+        mailbox.close()
+
+
+def test_start_server_without_mailbox_on_open_failure(tmp_path):
+    async def scenario():
+        task = asyncio.create_task(server.start_server(port=0, mailbox_path=str(tmp_path / "missing" / "mailbox.db")))
+        await asyncio.sleep(0.1)
+        try:
+            assert not task.done()
+            assert server.mailbox is None
+        finally:
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    run(scenario())
@@ -0,0 +1,269 @@
+import asyncio
+import contextlib
+import sys
+import threading
+import time
+
+import pytest
+
+import server
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    server.connected_clients.clear()
+    server.clients_by_name.clear()
+    server.chat_rooms.clear()
+    server.chat_rooms['main'] = set()
+    while not server.log_queue.empty():
+        server.log_queue.get()
+    yield
+
+
+@contextlib.asynccontextmanager
+async def running_server(**kwargs):
+    """Запуск сервера на свободном порту; возвращает список необработанных ошибок обработчиков."""
+    kwargs.setdefault('mailbox_path', None)
+    errors = []
+    asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+    task = asyncio.create_task(server.start_server(port=0, **kwargs))
+    while server.server_address is None:
+        await asyncio.sleep(0.01)
+    try:
+        yield errors
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def connect(name):
+    reader, writer = await asyncio.open_connection(*server.server_address)
+    await reader.readuntil(b'\n')
+    writer.write(f"{name}\n".encode())
+    return reader, writer
+
+
+async def login(name):
+    reader, writer = await connect(name)
+    await reader.readuntil("комнате: main\n".encode())
+    return reader, writer
+
+
+async def command(reader, writer, text):
+    writer.write(f"{text}\n".encode())
+    return (await asyncio.wait_for(reader.readuntil(b'\n'), 2)).decode().strip()
+
+
+async def wait_until(condition, timeout=2):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.01)
+
+
+def test_disconnect_cleans_up_without_errors():
+    async def scenario():
+        async with running_server() as errors:
+            reader, writer = await login('alice')
+            assert 'alice' in server.clients_by_name
+            writer.close()
+            await wait_until(lambda: not server.connected_clients)
+            await asyncio.sleep(0.05)
+            assert server.clients_by_name == {}
+            assert errors == []
+
+    run(scenario())
+
+
+def test_main_room_recreated_after_it_empties():
+    async def scenario():
+        async with running_server() as errors:
+            reader, writer = await login('alice')
+            assert await command(reader, writer, '/join other') == "Вы присоединились к комнате: other"
+            assert 'main' not in server.chat_rooms
+            reader2, writer2 = await login('bob')
+            assert server.clients_by_name['bob'].room == 'main'
+            assert server.chat_rooms['main'] == {server.clients_by_name['bob'].writer}
+            writer.close()
+            writer2.close()
+            await wait_until(lambda: not server.connected_clients)
+            assert errors == []
+
+    run(scenario())
+
+
+def test_duplicate_name_keeps_original_session():
+    async def scenario():
+        async with running_server():
+            reader, writer = await login('alice')
+            original = server.clients_by_name['alice']
+            reader2, writer2 = await connect('alice')
+            reply = (await reader2.readuntil(b'\n')).decode()
+            assert "имя уже занято" in reply
+            await wait_until(lambda: len(server.connected_clients) == 1)
+            assert server.clients_by_name['alice'] is original
+            assert await command(reader, writer, '/users') == "Список пользователей: alice"
+            writer.close()
+
+    run(scenario())
+
+
+def test_loop_stall_above_threshold_logs_stack():
+    def block_loop(seconds):
+        time.sleep(seconds)
+
+    async def scenario():
+        async with running_server(diagnostics_enabled=True):
+            threshold = server.diagnostics.slow_threshold
+            for _ in range(3):
+                await asyncio.sleep(0.05)
+                while not server.log_queue.empty():
+                    server.log_queue.get()
+                block_loop(threshold * 1.3)
+                await asyncio.sleep(0.05)
+                messages = []
+                while not server.log_queue.empty():
+                    messages.append(server.log_queue.get())
+                stacks = [m for m in messages if "Стек:" in m]
+                assert len(stacks) == 1, messages
+                assert "block_loop" in stacks[0]
+
+    run(scenario())
+
+
+def test_profile_requires_admin_token(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'PROFILE_DIR', str(tmp_path))
+
+    async def scenario():
+        async with running_server():
+            reader, writer = await login('admin')
+            refused = "Команда доступна только администраторам."
+            assert await command(reader, writer, '/profile start') == refused
+            assert await command(reader, writer, '/lag') == refused
+            monkeypatch.setattr(server, 'ADMIN_TOKEN', 's3cret')
+            assert await command(reader, writer, '/profile wrong start') == refused
+            assert server.profiler is None
+            assert await command(reader, writer, '/profile s3cret start') == "Профилирование запущено."
+            assert server.profiler is not None
+            reply = await command(reader, writer, '/profile s3cret stop')
+            assert reply.startswith("Профиль сохранен в ")
+            assert server.profiler is None
+            writer.close()
+        messages = []
+        while not server.log_queue.empty():
+            messages.append(server.log_queue.get())
+        assert not any('s3cret' in m for m in messages)
+
+    run(scenario())
+
+
+def test_toggle_stop_does_not_hold_lock_while_saving(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'PROFILE_DIR', str(tmp_path))
+    monkeypatch.setattr(server, 'loop_thread_id', threading.get_ident())
+    stop = server.SamplingProfiler.stop
+    saving = threading.Event()
+
+    def slow_stop(self, path):
+        saving.set()
+        time.sleep(0.5)
+        return stop(self, path)
+
+    monkeypatch.setattr(server.SamplingProfiler, 'stop', slow_stop)
+    assert server.toggle_profiling() == ('started', None)
+    toggler = threading.Thread(target=server.toggle_profiling)
+    toggler.start()
+    assert saving.wait(2)
+    started = time.monotonic()
+    assert server.start_profiling()
+    assert time.monotonic() - started < 0.1
+    toggler.join()
+    server.stop_profiling()
+
+
+def test_sampling_profiler_writes_collapsed_stacks(tmp_path):
+    done = threading.Event()
+
+    def spin_for_profiler():
+        while not done.is_set():
+            sum(range(1000))
+
+    worker = threading.Thread(target=spin_for_profiler)
+    worker.start()
+    profiler = server.SamplingProfiler(worker.ident, interval=0.001)
+    profiler.start()
+    time.sleep(0.2)
+    path = profiler.stop(str(tmp_path / "profile.folded"))
+    done.set()
+    worker.join()
+
+    lines = open(path).read().splitlines()
+    assert lines
+    total = 0
+    for line in lines:
+        stack, count = line.rsplit(' ', 1)
+        total += int(count)
+        for frame in stack.split(';'):
+            name, location = frame.split(' (')
+            assert name and location.endswith(')') and ':' in location
+    assert total == profiler.samples
+    assert any(line.split(' ', 1)[0] == '_bootstrap' and 'spin_for_profiler (test_server.py:' in line for line in lines)
+
+
+def test_large_room_skips_slow_consumers_and_notifies(monkeypatch):
+    monkeypatch.setattr(server, 'BROADCAST_CHUNK_THRESHOLD', 3)
+
+    async def scenario():
+        async with running_server():
+            clients = [await login(f"u{i}") for i in range(4)]
+            # Любой буфер считается переполненным: все получатели пропускают сообщение
+            monkeypatch.setattr(server, 'BROADCAST_MAX_BACKLOG', -1)
+            clients[0][1].write(b"first\n")
+            for reader, _ in clients[1:]:
+                line = (await asyncio.wait_for(reader.readuntil(b'\n'), 2)).decode().strip()
+                assert line == "Пропущено сообщений из-за медленного соединения: 1"
+            monkeypatch.setattr(server, 'BROADCAST_MAX_BACKLOG', 64 * 1024)
+            clients[0][1].write(b"second\n")
+            for reader, _ in clients[1:]:
+                line = (await asyncio.wait_for(reader.readuntil(b'\n'), 2)).decode().strip()
+                assert line == "u0: second"
+            for _, writer in clients:
+                writer.close()
+
+    run(scenario())
+
+
+def test_large_room_delivers_to_all_but_sender_in_chunks(monkeypatch):
+    monkeypatch.setattr(server, 'BROADCAST_CHUNK_THRESHOLD', 3)
+    monkeypatch.setattr(server, 'BROADCAST_CHUNK_SIZE', 2)
+    sleep = asyncio.sleep
+    yields = []
+
+    async def spy_sleep(delay, *args, **kwargs):
+        if sys._getframe(1).f_code.co_name == 'broadcast_large_room':
+            yields.append(delay)
+        return await sleep(delay, *args, **kwargs)
+
+    async def scenario():
+        async with running_server():
+            clients = [await login(f"u{i}") for i in range(6)]
+            monkeypatch.setattr(asyncio, 'sleep', spy_sleep)
+            clients[0][1].write(b"hello all\n")
+            for reader, _ in clients[1:]:
+                line = (await asyncio.wait_for(reader.readuntil(b'\n'), 2)).decode().strip()
+                assert line == "u0: hello all"
+            # Отправитель свое сообщение не получает
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(clients[0][0].readuntil(b'\n'), 0.2)
+            monkeypatch.setattr(asyncio, 'sleep', sleep)
+            assert server.clients_by_name['u1'].messages_received == 1
+            assert server.clients_by_name['u0'].messages_received == 0
+            for _, writer in clients:
+                writer.close()
+
+    run(scenario())
+    # 6 участников по 2 в части: уступка циклу после каждой из 3 частей
+    assert yields == [0, 0, 0]